@@ -7,6 +7,8 @@ import csv
 import sys
 import pathlib
 
+from collections import defaultdict
+
 FORMOSAN = [
     "Amis_Central_350",
     "Amis_Farang_800",
@@ -73,26 +75,31 @@ FORMOSAN = [
 
 
 def load(fname):
-    """Load cognate data file into list of DictRows"""
+    """Load cognate data file into list of dict rows"""
     with open(fname) as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        return [row for row in reader if row["Loan"] == "0"]
+        reader = csv.reader(f, delimiter="\t")
+        header = tuple(next(reader))
+        loan = header.index("Loan")
+        return [dict(zip(header, row)) for row in reader if row[loan] == "0"]
 
 
 def all_sets(rows):
-    return set([r["Cognacy"].split(",") for r in rows])
+    return {cognate for r in rows for cognate in r["Cognacy"].split(",")}
 
 
 def cognates_for_language(rows):
     """Go through each language and compile cognate set for that language"""
-    result = {}
+    result = defaultdict(set)
+    # The same Cognacy string recurs across many rows; split each distinct
+    # string only once
+    split_cache = {}
     for row in rows:
-        language = row["Language"]
-        cognates = set(row["Cognacy"].split(","))
-        if language in result:
-            result[language].update(cognates)
-        else:
-            result[language] = cognates
+        cognacy = row["Cognacy"]
+        cognates = split_cache.get(cognacy)
+        if cognates is None:
+            cognates = cognacy.split(",")
+            split_cache[cognacy] = cognates
+        result[row["Language"]].update(cognates)
     return result
 
 
@@ -2,45 +2,63 @@
 Useful for scripts which use Pyglottolog heavily to speed up access when using the same
 languoids multiple times in different scopes or running the same script multiple times
 """
+import shelve
+
 from cldfcatalog import Config
 from pyglottolog import Glottolog
-from pickle import dump, load
 from pathlib import Path
 
 
 class GlottoCache:
-    """Save loaded Glottolog languoids so we don't have to wait every time"""
-    def __init__(self, path, fname="glottocache.pickle"):
+    """Save summaries of loaded Glottolog languoids so we don't have to wait every time"""
+    def __init__(self, path, fname="glottocache"):
         if type(path) == str:
             path = Path(path)
         self.cachepath = path.joinpath(fname)
-        try:
-            with open(self.cachepath, "rb") as cachefile:
-                self.cache = load(cachefile)
-        except FileNotFoundError:
-            self.cache = {}
+        # shelve writes each new entry through to disk as it is added, so a
+        # cache miss costs one key write instead of re-serialising the whole
+        # cache, and nothing is lost if the interpreter dies
+        self.cache = shelve.open(str(self.cachepath))
+        # Full Languoid objects are only memoised for this run, not saved:
+        # they are heavy object graphs and slow to deserialise
+        self.languoids = {}
 
         cfg = Config.from_file()
         self.glottolog = Glottolog(cfg.get_clone("glottolog"))
-        # So we know whether to save
-        self.written = False
 
-    def __del__(self):
-        self.save()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def get(self, glottocode):
         if not glottocode:
             return None
-        elif glottocode in self.cache:
-            return self.cache[glottocode]
+        elif glottocode in self.languoids:
+            return self.languoids[glottocode]
         else:
             lg = self.glottolog.languoid(glottocode)
-            self.cache[glottocode] = lg
-            self.written = True
+            self.languoids[glottocode] = lg
             return lg
 
-    def save(self):
-        if self.written:
-            with open(self.cachepath, "wb+") as cachefile:
-                dump(self.cache, cachefile)
+    def get_summary(self, glottocode):
+        """Small dict of the languoid fields scripts actually need, so callers
+        aren't re-walking .ancestors every row. This is what gets cached on disk
+        """
+        if not glottocode:
+            return None
+        elif glottocode in self.cache:
+            return self.cache[glottocode]
+        else:
+            lg = self.get(glottocode)
+            summary = {"latitude": lg.latitude,
+                       "longitude": lg.longitude,
+                       "category": lg.category,
+                       "ancestor_names": tuple(a.name for a in lg.ancestors),
+                       "ancestor_codes": tuple(a.glottocode for a in lg.ancestors)}
+            self.cache[glottocode] = summary
+            return summary
 
+    def close(self):
+        self.cache.close()
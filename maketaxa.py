@@ -7,35 +7,39 @@ import csv
 import string
 import sys
 
+from collections import defaultdict
+
+## Built once rather than per call to make_nexus_block
+PUNCT_TABLE = str.maketrans("", "", string.punctuation)
+
 
 def load_lang_file(fname):
     with open(fname) as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        out = list()
-        for row in reader: # lowercase field names
-            newrow = dict()
-            for k, v in row.items():
-                newrow[k.lower()] = v
-            out.append(newrow)
-    return out
+        reader = csv.reader(f, delimiter="\t")
+        header = tuple(k.lower() for k in next(reader)) # lowercase field names
+        return [dict(zip(header, row)) for row in reader]
 
 
-def find_taxa(rows, taxname):
-    """Find all rows where `taxname` in classification field"""
-    result = []
+def build_index(rows):
+    """Invert the classification field into a clade -> slugs mapping, so each
+    classification string is split once rather than once per queried taxon"""
+    index = defaultdict(list)
     for row in rows:
-        clades = [c.lstrip() for c in row["classification"].split(",")]
-        if taxname in clades:
-            result.append(row["slug"])
-    return taxname, result
+        for clade in row["classification"].split(","):
+            index[clade.strip()].append(row["slug"])
+    return index
+
+
+def find_taxa(index, taxname):
+    """Find all rows where `taxname` in classification field"""
+    return taxname, index.get(taxname, [])
 
 
 def make_nexus_block(name_and_taxa):
     """Return properly formatted nexus block of `taxa`"""
     taxname, result = name_and_taxa
-    setname = taxname.translate(str.maketrans('', '', string.punctuation))
-    template = "taxset {} {};"
-    return template.format(setname, " ".join(result))
+    setname = taxname.translate(PUNCT_TABLE)
+    return f"taxset {setname} {' '.join(result)};"
 
 
 def make_xml_block(name_and_taxa):
@@ -47,8 +51,9 @@ def main():
     lang_file = sys.argv[1]
     taxnames = sys.argv[2].split(",")
     rows = load_lang_file(lang_file)
+    index = build_index(rows)
     for tax in taxnames:
-        taxa = find_taxa(rows, tax)
+        taxa = find_taxa(index, tax)
         print(make_nexus_block(taxa))
 
 
@@ -7,17 +7,14 @@ and/or
 August 2022
 """
 import csv
-import itertools
 import sys
 import tabulate
 
-import geopy.distance as distance
-import shapely.geometry as geometry
+import numba
+import numpy as np
+import pandas as pd
 
-from cldfcatalog import Config
-from pyglottolog import Glottolog
-from pickle import dump, load
-from pathlib import Path
+from glottocache import GlottoCache
 
 MICROGROUPS = [
     "Batanic",
@@ -69,160 +66,161 @@ REGIONALS = [
     "hili1240", # Hiligaynon
     "wara1300" # Waray
 ]
-    
-class GlottoCache:
-    """Save loaded Glottolog languoids so we don't have to wait every time"""
-    def __init__(self, path, fname="glottocache.pickle"):
-        if type(path) == str:
-            path = Path(path)
-        self.cachepath = path.joinpath(fname)
-        try:
-            with open(self.cachepath, "rb") as cachefile:
-                self.cache = load(cachefile)
-        except FileNotFoundError:
-            self.cache = {}
-
-        cfg = Config.from_file()
-        self.glottolog = Glottolog(cfg.get_clone("glottolog"))
-        # So we know whether to save
-        self.written = False
-
-    def __del__(self):
-        self.save()
-
-    def get(self, glottocode):
-        if not glottocode:
-            return None
-        elif glottocode in self.cache:
-            return self.cache[glottocode]
-        else:
-            lg = self.glottolog.languoid(glottocode)
-            self.cache[glottocode] = lg
-            self.written = True
-            return lg
-
-    def save(self):
-        if self.written:
-            with open(self.cachepath, "wb+") as cachefile:
-                dump(self.cache, cachefile)
+
+## Frozen copy for O(1) membership tests
+REGIONALS_SET = frozenset(REGIONALS)
+
+## Mean earth radius used by the haversine formula
+EARTH_RADIUS_KM = 6371.0088
 
 
 def load_data(path, delimiter="\t"):
-    with open(path) as f:
-        rows = [row for row in csv.DictReader(f, delimiter=delimiter)]
-    return rows
+    """Load the reflex list into a DataFrame. pandas parses the CSV in C and
+    stores columns contiguously, rather than building a dict per row
+    """
+    return pd.read_csv(path, sep=delimiter)
 
 
-def attach_glottolog_data(glottocache, rows):
+def microgroup_mask(ancestor_names):
+    """Encode which of MICROGROUPS appear among `ancestor_names` as a bitmask,
+    bit i standing for MICROGROUPS[i]. 15 groups, so it fits a uint16"""
+    mask = 0
+    for i, name in enumerate(MICROGROUPS):
+        if name in ancestor_names:
+            mask |= 1 << i
+    return mask
+
+
+def attach_glottolog_data(glottocache, df):
     """Add location and subgroup data from Glottolog"""
-    cache = {}
-    result = []
-    for row in rows:
-        code = row["GlottoCode"]
-        if code: # Some ACD entries don't have glottocodes
-            if code not in cache:
-                lg = glottocache.get(code)
-                cache[code] = {"Latitude": lg.latitude,
-                               "Longitude": lg.longitude,
-                               "Ancestors": [a.name for a in lg.ancestors]}
-            result.append(row | cache[code])
-    return result
+    df = df[df["GlottoCode"].notna()].copy() # Some ACD entries don't have glottocodes
+    summaries = {code: glottocache.get_summary(code) for code in df["GlottoCode"].unique()}
+    df["Latitude"] = df["GlottoCode"].map(lambda code: summaries[code]["latitude"])
+    df["Longitude"] = df["GlottoCode"].map(lambda code: summaries[code]["longitude"])
+    df["Ancestors"] = df["GlottoCode"].map(lambda code: summaries[code]["ancestor_names"])
+    masks = {code: microgroup_mask(summary["ancestor_names"])
+             for code, summary in summaries.items()}
+    df["MGMask"] = df["GlottoCode"].map(masks).astype(np.uint16)
+    return df
+
+
+def compute_centroid(lg):
+    """Mean position of the family members which have coordinates. Cheaper
+    than building a shapely Polygon just to take its centroid, and still
+    defined for families with fewer than three located members
+    """
+    coords = np.array([(m.latitude, m.longitude) for m in lg.iter_descendants() if m.latitude],
+                      dtype=np.float64)
+    if len(coords) == 0:
+        return None
+    return coords.mean(axis=0)
 
 
-def interpolate_positions(glottocache, rows):
+def interpolate_positions(glottocache, df):
     """Estimate missing coordinate data.
     Some languages as referred to in the ACD are listed as families in Glottolog,
     e.g. Bikol. Treat the positions for these as the centroid of the positions
     of the member languages of the family
     """
-    cache = {}
-    result = []
-    for row in rows:
-        code = row["GlottoCode"]
-        latitude = row["Latitude"]
-        lg = glottocache.get(code)
-        if latitude == None and lg.category == "Family":
-            if code not in cache:
-                lg = glottocache.get(code)
-                member_coords = [(m.latitude, m.longitude) for m in lg.iter_descendants() if m.latitude]
-                centroid = geometry.Polygon(member_coords).centroid
-                cache[code] = centroid
+    # One descendant traversal per distinct family code, done upfront, rather
+    # than inside the row loop
+    family_codes = {code for code, latitude in zip(df["GlottoCode"], df["Latitude"])
+                    if pd.isna(latitude) and glottocache.get_summary(code)["category"] == "Family"}
+    centroids = {code: compute_centroid(glottocache.get(code)) for code in family_codes}
+    latitudes, longitudes, interpolated = [], [], []
+    for code, latitude, longitude in zip(df["GlottoCode"], df["Latitude"], df["Longitude"]):
+        interp = False
+        if code in centroids:
+            centroid = centroids[code]
+            if centroid is None:
+                print("No member coordinates to interpolate from for", code)
             else:
-                centroid = cache[code]
-            try:
-                row["Latitude"] = centroid.x
-                row["Longitude"] = centroid.y
-                row["InterpolatedDistance"] = True    
-            except IndexError:
-                print(row["GlottologName"], centroid.wkt)
-        else:
-            row["InterpolatedDistance"] = False
-        result.append(row)
-    return result
+                latitude, longitude = centroid
+                interp = True
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        interpolated.append(interp)
+    df["Latitude"] = latitudes
+    df["Longitude"] = longitudes
+    df["InterpolatedDistance"] = interpolated
+    return df
+
+
+def groupby(df, field):
+    """Group rows according to field value. Returns a pandas GroupBy over
+    the cognate sets"""
+    return df.groupby(field)
+
+
+@numba.njit(fastmath=True, cache=True)
+def pairwise_haversine_stats(lats, lons):
+    """Min, max and mean haversine distance in km over every unique pair of
+    coordinates, given in radians. Compiled to a single tight loop: no n x n
+    intermediate arrays, which matters for protoforms with many reflexes
+    """
+    n = len(lats)
+    mindist = np.inf
+    maxdist = -np.inf
+    total = 0.0
+    npairs = 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            dlat = lats[j] - lats[i]
+            dlon = lons[j] - lons[i]
+            a = np.sin(dlat / 2) ** 2 + np.cos(lats[i]) * np.cos(lats[j]) * np.sin(dlon / 2) ** 2
+            d = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+            if d < mindist:
+                mindist = d
+            if d > maxdist:
+                maxdist = d
+            total += d
+            npairs += 1
+    return mindist, maxdist, total / npairs
+
+
+def compute_distances(lats, lons):
+    """Summary statistics (min, max, mean) of the haversine distance in km
+    between each unique pair of languages which have reflexes of this cognate
+    set
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    return pairwise_haversine_stats(lats, lons)
 
 
-def groupby(rows, field):
-    """Group rows according to field value. Returns {field_value: rows} dict"""
-    grouped = {}
-    for row in rows:
-        protoform = row["ProtoForm"]
-        if protoform in grouped:
-            grouped[protoform].append(row)
-        else:
-            grouped[protoform] = [row]
-    return grouped
+def decode_microgroups(mask):
+    """Set of microgroup names encoded in a bitmask"""
+    return {MICROGROUPS[i] for i in range(len(MICROGROUPS)) if mask >> i & 1}
 
 
-def compute_distances(rows):
-    """Calculate summary statistics for distances between languages which have
-    reflexes of this cognate set
-    """
-    coords = [(row["Latitude"], row["Longitude"]) for row in rows] # geopy.distance.distance wants latitude first
-    # Distance between each pair of languages
-    distances = []
-    for a, b in itertools.product(coords, repeat=2):
-        try:
-            if a != b:
-                km = distance.distance(a, b).km
-                distances.append(km)
-        except ValueError:
-            print("Couldn't calculate distance for {}, {}".format(a, b))
-    return set(distances)
-
-
-def get_unique_microgroups(glottocache, groups, rows, attr="glottocode"):
-    """Count unique subgroups for this cognate set"""
-    microgroups = []
-    for row in rows:
-        lg = glottocache.get(row["GlottoCode"])
-        ancestors = [getattr(a, attr) for a in lg.ancestors]
-        for group in groups:
-            if group in ancestors:
-                microgroups.append(group)
-    return set(microgroups)
-
-
-def summarise_lexical_data(glottocache, grouped):
+def summarise_lexical_data(grouped):
     """Search for subgroup or geographically limited cognate sets.
     Instead of using an arbitrary distance cutoff, calculate the maximum distance
     between reflexes within a set.
     """
     result = []
-    for protoform, rows in grouped.items():
+    # One vectorised pass computes the flag for every set, rather than
+    # re-scanning the rows inside each group
+    interpolated = grouped["InterpolatedDistance"].any()
+    for protoform, rows in grouped:
         if len(rows) > 1:
             # Distances
-            distances = compute_distances(rows)
-            unique_groups = get_unique_microgroups(glottocache, MICROGROUPS, rows, attr="name")
+            mindist, maxdist, meandist = compute_distances(rows["Latitude"].to_numpy(),
+                                                           rows["Longitude"].to_numpy())
+            # Branchless accumulation: the microgroups present across the
+            # whole set are just the OR of the per-row masks
+            group_mask = int(np.bitwise_or.reduce(rows["MGMask"].to_numpy()))
+            unique_groups = decode_microgroups(group_mask)
             set_row = {
                 "protoform": protoform,
                 "reflexes": len(rows),
-                "maxdist": max(distances),
-                "mindist": min(distances),
-                "meandist": sum(distances) / len(distances),
-                "interpolated": True if any([row["InterpolatedDistance"] for row in rows]) else False,
+                "maxdist": maxdist,
+                "mindist": mindist,
+                "meandist": meandist,
+                "interpolated": bool(interpolated[protoform]),
                 "microgroups": unique_groups,
-                "nmicrogroups": len(unique_groups),
-                "hasregionallang": has_languages(REGIONALS, rows)
+                "nmicrogroups": bin(group_mask).count("1"),
+                "hasregionallang": has_languages(REGIONALS_SET, rows)
             }
             result.append(set_row)
     return result
@@ -230,7 +228,7 @@ def summarise_lexical_data(glottocache, grouped):
 
 def has_languages(languages, rows):
     """Utility function to add a column for languages of interest e.g. linguas franca"""
-    return bool(len([r for r in rows if r["GlottoCode"] in languages]))
+    return any(code in languages for code in rows["GlottoCode"])
 
 ##
 ## Clustering analysis: attempting to confirm Zorc's (2021) interaction axes by
@@ -244,37 +242,37 @@ import gower
 
 
 def build_microgroup_matrix(rows):
-    """Transform the result of find_suspicious_sets into a presence/absence
-    matrix with one column per microgroup
+    """Transform the result of summarise_lexical_data into a presence/absence
+    matrix with one column per microgroup. Returns a DataFrame backed by an
+    int8 array which gower/sklearn can consume without further conversion
     """
-    matrix = []
-    for row in rows:
-        matrix_row = {"protoform": row["protoform"], "meandist": row["meandist"]}
-        for mg in MICROGROUPS:
-            state = 1 if mg in row["microgroups"] else 0
-            matrix_row[mg] = state
-        matrix.append(matrix_row)
+    states = np.zeros((len(rows), len(MICROGROUPS)), dtype=np.int8)
+    for i, row in enumerate(rows):
+        for j, mg in enumerate(MICROGROUPS):
+            if mg in row["microgroups"]:
+                states[i, j] = 1
+    matrix = pd.DataFrame(states, columns=MICROGROUPS)
+    matrix.insert(0, "meandist", [row["meandist"] for row in rows])
+    matrix.insert(0, "protoform", [row["protoform"] for row in rows])
     return matrix
 
 
 def main():
-    gc = GlottoCache(".")
     infile, summaryfile, matrixfile = sys.argv[1:]
-    data = load_data(infile)
-    rows = attach_glottolog_data(gc, data)
-    rows = interpolate_positions(gc, rows)
-    grouped = groupby(rows, "Protoform")
-    summary = summarise_lexical_data(gc, grouped)
+    with GlottoCache(".") as gc:
+        df = load_data(infile)
+        df = attach_glottolog_data(gc, df)
+        df = interpolate_positions(gc, df)
+        grouped = groupby(df, "ProtoForm")
+        summary = summarise_lexical_data(grouped)
     matrix = build_microgroup_matrix(summary)
 
+    fieldnames = list(summary[0].keys())
     with open(summaryfile, "w") as f:
-        writer = csv.DictWriter(f, fieldnames=summary[0].keys(), delimiter="\t")
-        writer.writeheader()
-        writer.writerows(summary)
-    with open(matrixfile, "w") as f:
-        writer = csv.DictWriter(f, fieldnames=matrix[0].keys(), delimiter="\t")
-        writer.writeheader()
-        writer.writerows(matrix)
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(fieldnames)
+        writer.writerows([row[field] for field in fieldnames] for row in summary)
+    matrix.to_csv(matrixfile, sep="\t", index=False)
     
 
 if __name__ == "__main__":